@@ -1,13 +1,22 @@
 import os
+import sys
 import subprocess
 import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
 import tkinter as tk
 from tkinter import ttk, scrolledtext, messagebox, filedialog
 import whisper
+import torch
 import re
 import time
 from datetime import timedelta
 import traceback
+import tempfile
+import ctypes
+import mmap
+import pickle
 
 # Constantes globales
 RATE = 16000
@@ -15,6 +24,7 @@ CHANNELS = 2
 SRT_OUTPUT_BASE = "subtitles"
 MKV_OUTPUT_BASE = "output"
 WHISPER_MODELS = ["tiny", "base", "small", "medium", "large"]
+MODEL_CACHE_DIR = os.environ.get("WHISPERMAX_CACHE", os.path.join(os.path.expanduser("~"), ".cache", "whispermax"))
 LANGUAGES = ["fr"]
 transcriptions = {}
 running = False
@@ -22,6 +32,8 @@ gui_log = None
 progress_label = None
 print_lock = threading.Lock()
 model = None
+shared_model = None
+loaded_model_name = None
 
 def get_unique_filename(filepath):
     """Génère un nom de fichier unique en ajoutant un suffixe numérique si le fichier existe."""
@@ -149,6 +161,11 @@ def transcribe_audio(lang, video_id, video_title, temp_wav_files=None):
             if gui_log:
                 gui_log.insert(tk.END, f"Erreur transcription {temp_wav} : {e}\n")
                 gui_log.see(tk.END)
+    write_transcription_files(lang, video_id, video_title, transcription)
+
+def write_transcription_files(lang, video_id, video_title, transcription):
+    """Enregistre une transcription et génère les fichiers texte/SRT correspondants."""
+    global transcriptions
     transcriptions[lang].append((video_id, transcription))
     output_file = os.path.normpath(f"transcriptions_{sanitize_filename(video_title)}_{lang}.txt")
     with open(output_file, "w", encoding="utf-8") as f:
@@ -166,6 +183,385 @@ def transcribe_audio(lang, video_id, video_title, temp_wav_files=None):
         gui_log.insert(tk.END, f"Fichiers générés : {output_file}, {srt_file}\n")
         gui_log.see(tk.END)
 
+def get_model_checksum(model_name):
+    """Renvoie le SHA256 du checkpoint officiel d'un modèle, tel qu'indiqué dans l'URL de téléchargement de Whisper."""
+    url = getattr(whisper, "_MODELS", {}).get(model_name)
+    if url is None:
+        return "local"
+    return url.split("/")[-2]
+
+def get_cached_model_path(model_name):
+    """Renvoie le chemin du fichier de poids mappable en mémoire d'un modèle dans le cache local.
+
+    Le nom inclut le SHA256 du checkpoint d'origine : si une mise à jour de Whisper fait pointer
+    un nom (par exemple "large") vers d'autres poids, un nouveau fichier est converti.
+    """
+    return os.path.join(MODEL_CACHE_DIR, f"{model_name}-{get_model_checksum(model_name)[:16]}.mmap.pt")
+
+def log_load_time(model_name, stage, seconds, run_type, device="cpu"):
+    """Affiche une mesure de temps de chargement (conversion, mappage, lecture des pages) d'un modèle."""
+    with print_lock:
+        print(f"Temps {stage} du modèle {model_name} (démarrage {run_type}, {device}) : {seconds:.2f} s")
+    if gui_log:
+        gui_log.insert(tk.END, f"Temps {stage} du modèle {model_name} (démarrage {run_type}, {device}) : {seconds:.2f} s\n")
+        gui_log.see(tk.END)
+
+def supports_mapped_loading():
+    """Vérifie que PyTorch permet torch.load(mmap=True) et load_state_dict(assign=True) (version 2.1 ou plus)."""
+    try:
+        major, minor = (int(part) for part in torch.__version__.split(".")[:2])
+    except ValueError:
+        return False
+    return (major, minor) >= (2, 1)
+
+def get_resident_fraction(path):
+    """Renvoie la fraction des pages d'un fichier déjà présentes dans le cache de pages (via mincore), ou None."""
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        with open(path, "rb") as f:
+            size = os.fstat(f.fileno()).st_size
+            if size == 0:
+                return None
+            mapped = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+        try:
+            address = ctypes.c_char.from_buffer(mapped)
+            num_pages = (size + mmap.PAGESIZE - 1) // mmap.PAGESIZE
+            pages = (ctypes.c_ubyte * num_pages)()
+            result = libc.mincore(ctypes.c_void_p(ctypes.addressof(address)), ctypes.c_size_t(size), pages)
+            del address
+        finally:
+            mapped.close()
+    except (OSError, AttributeError, TypeError, ValueError, BufferError):
+        return None
+    if result != 0:
+        return None
+    return sum(page & 1 for page in pages) / num_pages
+
+def _touch_model_pages(model):
+    """Lit un octet par page des poids mappés, pour mesurer le coût de chargement des pages indépendamment de l'inférence."""
+    for tensor in list(model.parameters()) + list(model.buffers()):
+        if tensor.device.type != "cpu" or tensor.layout != torch.strided or tensor.numel() == 0:
+            continue
+        tensor.detach().reshape(-1).view(torch.uint8)[::mmap.PAGESIZE].sum()
+
+def convert_model_to_cache(model_name):
+    """Convertit un modèle Whisper en fichier de poids mappable en mémoire dans le cache local.
+
+    Les poids sont enregistrés en float32 dans le format zip de PyTorch, ce qui permet ensuite
+    de les mapper directement avec torch.load(mmap=True) sans copie ni conversion.
+    """
+    os.makedirs(MODEL_CACHE_DIR, exist_ok=True)
+    cache_path = get_cached_model_path(model_name)
+    with print_lock:
+        print(f"Conversion du modèle {model_name} vers {cache_path}")
+    if gui_log:
+        gui_log.insert(tk.END, f"Conversion du modèle {model_name} vers {cache_path}\n")
+        gui_log.see(tk.END)
+    start = time.perf_counter()
+    source = whisper.load_model(model_name, device="cpu")
+    checkpoint = {
+        "dims": dict(source.dims.__dict__),
+        "sha256": get_model_checksum(model_name),
+        "model_state_dict": source.state_dict(),
+    }
+    # Fichier temporaire unique : plusieurs processus peuvent convertir le même modèle en même temps.
+    fd, temp_path = tempfile.mkstemp(dir=MODEL_CACHE_DIR, prefix=f"{model_name}-", suffix=".tmp")
+    os.close(fd)
+    try:
+        torch.save(checkpoint, temp_path)
+        os.replace(temp_path, cache_path)
+    except Exception:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+    log_load_time(model_name, "conversion", time.perf_counter() - start, "froid")
+
+def convert_all_models():
+    """Convertit une fois pour toutes chaque modèle de WHISPER_MODELS absent du cache local."""
+    for model_name in WHISPER_MODELS:
+        if os.path.exists(get_cached_model_path(model_name)):
+            with print_lock:
+                print(f"Modèle {model_name} déjà présent dans le cache")
+            continue
+        convert_model_to_cache(model_name)
+
+def _build_empty_model(dims):
+    """Construit un modèle Whisper sans allouer ni initialiser ses poids, qui seront remplacés par ceux du cache.
+
+    Le squelette est créé sur le device "meta". Les deux buffers non persistants, absents du
+    checkpoint (le masque causal du décodeur et alignment_heads), sont ensuite recréés sur CPU.
+    """
+    with torch.device("meta"):
+        skeleton = whisper.model.Whisper(dims)
+    mask = torch.empty(dims.n_text_ctx, dims.n_text_ctx).fill_(-float("inf")).triu_(1)
+    skeleton.decoder.register_buffer("mask", mask, persistent=False)
+    all_heads = torch.zeros(dims.n_text_layer, dims.n_text_head, dtype=torch.bool)
+    all_heads[dims.n_text_layer // 2 :] = True
+    skeleton.register_buffer("alignment_heads", all_heads.to_sparse(), persistent=False)
+    return skeleton
+
+def _load_mapped_model(model_name):
+    """Charge un modèle depuis le cache en mappant ses poids en mémoire, sans les copier."""
+    checkpoint = torch.load(get_cached_model_path(model_name), map_location="cpu", mmap=True, weights_only=True)
+    if checkpoint.get("sha256") != get_model_checksum(model_name):
+        raise ValueError(f"SHA256 du cache ({checkpoint.get('sha256')}) différent de celui de Whisper ({get_model_checksum(model_name)})")
+    mapped = _build_empty_model(whisper.model.ModelDimensions(**checkpoint["dims"]))
+    mapped.load_state_dict(checkpoint["model_state_dict"], assign=True)
+    alignment_heads = getattr(whisper, "_ALIGNMENT_HEADS", {}).get(model_name)
+    if alignment_heads is not None:
+        mapped.set_alignment_heads(alignment_heads)
+    return mapped
+
+def load_model_cached(model_name, device=None):
+    """Charge un modèle Whisper via le cache de poids mappés en mémoire et mesure les temps de chargement.
+
+    Si le modèle n'est pas encore dans le cache, il est d'abord converti. Le modèle est ensuite
+    toujours chargé en mappant le fichier, puis ses pages sont lues une fois pour mesurer leur
+    coût séparément. Le démarrage est "froid" si le modèle vient d'être converti ou si moins de
+    la moitié du fichier était dans le cache de pages, "chaud" sinon.
+    """
+    global loaded_model_name
+    if device is None:
+        device = "cuda" if torch.cuda.is_available() else "cpu"
+    if not supports_mapped_loading():
+        with print_lock:
+            print(f"PyTorch {torch.__version__} ne permet pas le chargement mappé (2.1 requis), chargement classique")
+        if gui_log:
+            gui_log.insert(tk.END, f"PyTorch {torch.__version__} ne permet pas le chargement mappé (2.1 requis), chargement classique\n")
+            gui_log.see(tk.END)
+        loaded_model_name = None
+        return whisper.load_model(model_name, device=device)
+    cache_path = get_cached_model_path(model_name)
+    converted = not os.path.exists(cache_path)
+    if converted:
+        convert_model_to_cache(model_name)
+    resident = get_resident_fraction(cache_path)
+    start = time.perf_counter()
+    try:
+        loaded = _load_mapped_model(model_name)
+    except (ValueError, RuntimeError, pickle.UnpicklingError, EOFError, OSError) as e:
+        with print_lock:
+            print(f"Cache du modèle {model_name} invalide, reconversion : {e}")
+        if gui_log:
+            gui_log.insert(tk.END, f"Cache du modèle {model_name} invalide, reconversion : {e}\n")
+            gui_log.see(tk.END)
+        convert_model_to_cache(model_name)
+        converted = True
+        start = time.perf_counter()
+        loaded = _load_mapped_model(model_name)
+    map_seconds = time.perf_counter() - start
+    if converted or (resident is not None and resident < 0.5):
+        run_type = "froid"
+    elif resident is None:
+        run_type = "inconnu"
+    else:
+        run_type = "chaud"
+    if resident is not None:
+        run_type = f"{run_type}, {resident:.0%} des pages déjà en cache"
+    log_load_time(model_name, "mappage", map_seconds, run_type, device)
+    start = time.perf_counter()
+    _touch_model_pages(loaded)
+    loaded = loaded.to(device)
+    log_load_time(model_name, "lecture des pages", time.perf_counter() - start, run_type, device)
+    loaded_model_name = model_name
+    return loaded
+
+def can_share_model(model):
+    """Vérifie si les workers peuvent partager les poids du modèle via le cache mappé en mémoire."""
+    if not loaded_model_name or not os.path.exists(get_cached_model_path(loaded_model_name)):
+        return False
+    return next(model.parameters()).device.type == "cpu"
+
+def _init_worker(model_name, num_threads):
+    """Initialise un worker : limite ses threads PyTorch et mappe les poids du cache partagé."""
+    global shared_model, loaded_model_name
+    torch.set_num_threads(num_threads)
+    loaded_model_name = model_name
+    shared_model = _load_mapped_model(model_name).eval()
+
+def _run_transcription_task(task_model, task):
+    """Transcrit un couple (langue, fichier audio) et renvoie les segments ou le message d'erreur."""
+    lang, temp_wav = task
+    try:
+        with torch.no_grad():
+            result = task_model.transcribe(temp_wav, language=None if lang == "auto" else lang)
+        return lang, temp_wav, result["segments"], None
+    except Exception as e:
+        return lang, temp_wav, [], str(e)
+
+def _transcribe_worker(task):
+    """Transcrit un fichier audio dans un worker et mesure sa mémoire en fin de tâche, modèle encore chargé."""
+    return _run_transcription_task(shared_model, task) + (get_process_memory(os.getpid(), get_cached_model_path(loaded_model_name)),)
+
+def create_worker_pool(model_name, num_workers):
+    """Crée un pool de processus partageant en lecture seule les poids du modèle.
+
+    Les workers sont lancés en "spawn" (pas de fork d'un processus multithread ayant déjà utilisé
+    OpenMP) et mappent chacun le même fichier du cache : les pages des poids sont partagées par le
+    cache de pages du système, une seule copie réside en mémoire.
+    """
+    num_threads = max(1, (os.cpu_count() or 1) // num_workers)
+    pool = ProcessPoolExecutor(
+        max_workers=num_workers,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(model_name, num_threads),
+    )
+    with print_lock:
+        print(f"Pool de {num_workers} processus créé ({num_threads} threads chacun), poids partagés via le cache mappé")
+    if gui_log:
+        gui_log.insert(tk.END, f"Pool de {num_workers} processus créé ({num_threads} threads chacun), poids partagés via le cache mappé\n")
+        gui_log.see(tk.END)
+    return pool
+
+def get_model_size_mb(model):
+    """Calcule la taille en Mo des poids (paramètres et buffers) du modèle."""
+    tensors = list(model.parameters()) + list(model.buffers())
+    return sum(t.numel() * t.element_size() for t in tensors) / (1024 * 1024)
+
+def get_mapping_memory(pid, path):
+    """Lit la mémoire RSS/PSS/partagée (en Mo) des mappages d'un fichier dans un processus, depuis /proc/<pid>/smaps.
+
+    Les pages "copiées" (Private_Dirty) sont celles que le processus a modifiées et donc dupliquées.
+    """
+    fields = {"Rss": 0, "Pss": 0, "Shared_Clean": 0, "Shared_Dirty": 0, "Private_Clean": 0, "Private_Dirty": 0}
+    target = os.path.realpath(path)
+    in_target = False
+    try:
+        with open(f"/proc/{pid}/smaps", encoding="utf-8") as f:
+            for line in f:
+                if re.match(r"^[0-9a-f]+-[0-9a-f]+ ", line):
+                    parts = line.split(None, 5)
+                    in_target = len(parts) == 6 and parts[5].strip() == target
+                    continue
+                key, _, value = line.partition(":")
+                if in_target and key in fields:
+                    fields[key] += int(value.split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return {
+        "rss": fields["Rss"] / 1024,
+        "pss": fields["Pss"] / 1024,
+        "shared": (fields["Shared_Clean"] + fields["Shared_Dirty"]) / 1024,
+        "copied": fields["Private_Dirty"] / 1024,
+    }
+
+def get_process_memory(pid, weights_path=None):
+    """Lit la mémoire RSS/PSS/partagée/privée et le pic de RSS (en Mo) d'un processus depuis /proc (Linux uniquement).
+
+    Si weights_path est fourni, la part due au fichier de poids mappé est détaillée sous la clé "weights".
+    """
+    fields = {"Rss": 0, "Pss": 0, "Shared_Clean": 0, "Shared_Dirty": 0, "Private_Clean": 0, "Private_Dirty": 0, "VmHWM": 0}
+    try:
+        for proc_file in ("smaps_rollup", "status"):
+            with open(f"/proc/{pid}/{proc_file}", encoding="utf-8") as f:
+                for line in f:
+                    key, _, value = line.partition(":")
+                    if key in fields:
+                        fields[key] = int(value.split()[0])
+    except (OSError, ValueError, IndexError):
+        return None
+    return {
+        "pid": pid,
+        "rss": fields["Rss"] / 1024,
+        "rss_peak": fields["VmHWM"] / 1024,
+        "pss": fields["Pss"] / 1024,
+        "shared": (fields["Shared_Clean"] + fields["Shared_Dirty"]) / 1024,
+        "private": (fields["Private_Clean"] + fields["Private_Dirty"]) / 1024,
+        "weights": get_mapping_memory(pid, weights_path) if weights_path else None,
+    }
+
+def report_pool_memory(main_usage, worker_usages, model):
+    """Affiche la répartition mémoire RSS/PSS du processus principal et des workers, et la part des poids mappés.
+
+    La preuve du partage repose sur le mappage du fichier de poids lui-même : si chaque processus
+    en avait une copie, la somme de ses PSS vaudrait le RSS cumulé ; partagé, elle reste proche
+    d'une seule copie du modèle.
+    """
+    usages = [("principal", main_usage)]
+    # Un worker peut traiter plusieurs tâches : on garde sa dernière mesure.
+    latest = {usage["pid"]: usage for usage in worker_usages if usage}
+    usages += [(f"worker {i}", usage) for i, usage in enumerate(latest.values())]
+    lines = ["Mesures mémoire : workers en fin de leur dernière tâche, principal après la dernière tâche, workers encore actifs (mesures non simultanées)"]
+    total_pss = 0
+    weights_rss = 0
+    weights_pss = 0
+    weights_copied = 0
+    for name, usage in usages:
+        if usage is None:
+            lines.append(f"Mémoire {name} : indisponible")
+            continue
+        total_pss += usage["pss"]
+        line = (f"Mémoire {name} (pid {usage['pid']}) : RSS={usage['rss']:.0f} Mo (pic {usage['rss_peak']:.0f} Mo), "
+                f"PSS={usage['pss']:.0f} Mo, partagée={usage['shared']:.0f} Mo, privée={usage['private']:.0f} Mo")
+        weights = usage.get("weights")
+        if weights:
+            weights_rss += weights["rss"]
+            weights_pss += weights["pss"]
+            weights_copied += weights["copied"]
+            line += (f" ; poids mappés : RSS={weights['rss']:.0f} Mo, PSS={weights['pss']:.0f} Mo, "
+                     f"partagée={weights['shared']:.0f} Mo, copiée={weights['copied']:.0f} Mo")
+        lines.append(line)
+    model_mb = get_model_size_mb(model)
+    lines.append(f"Mémoire totale : PSS={total_pss:.0f} Mo, dont poids mappés PSS={weights_pss:.0f} Mo "
+                 f"et activations/environnement {total_pss - weights_pss:.0f} Mo")
+    lines.append(f"Poids du modèle ({model_mb:.0f} Mo) : PSS cumulé={weights_pss:.0f} Mo, soit {weights_pss / model_mb:.2f} copie(s) "
+                 f"résidente(s) pour {len(usages)} processus ; RSS cumulé={weights_rss:.0f} Mo (coût sans partage), "
+                 f"pages copiées={weights_copied:.0f} Mo")
+    for line in lines:
+        with print_lock:
+            print(line)
+        if gui_log:
+            gui_log.insert(tk.END, f"{line}\n")
+            gui_log.see(tk.END)
+    return total_pss
+
+def transcribe_languages_parallel(languages, video_id, video_title, model, num_workers, temp_wav_files=None):
+    """Transcrit un fichier audio dans plusieurs langues en parallèle avec un pool partageant le modèle.
+
+    Si un worker meurt (par exemple tué faute de mémoire), l'exécuteur arrête les autres workers
+    et seules les tâches restées sans résultat sont reprises dans le processus principal.
+    """
+    tasks = [(lang, temp_wav) for lang in languages for temp_wav in temp_wav_files or []]
+    for lang, temp_wav in tasks:
+        with print_lock:
+            print(f"Transcription {temp_wav} en {lang} (pool)")
+        if gui_log:
+            gui_log.insert(tk.END, f"Transcription {temp_wav} en {lang} (pool)\n")
+            gui_log.see(tk.END)
+    pool = create_worker_pool(loaded_model_name, num_workers)
+    futures = [pool.submit(_transcribe_worker, task) for task in tasks]
+    results = []
+    missing = []
+    for task, future in zip(tasks, futures):
+        try:
+            results.append(future.result())
+        except BrokenProcessPool:
+            results.append(None)
+            missing.append(task)
+    main_usage = get_process_memory(os.getpid(), get_cached_model_path(loaded_model_name))
+    pool.shutdown()
+    if missing:
+        with print_lock:
+            print(f"Erreur pool de transcription (worker arrêté brutalement), reprise séquentielle de {len(missing)} tâche(s)")
+        if gui_log:
+            gui_log.insert(tk.END, f"Erreur pool de transcription (worker arrêté brutalement), reprise séquentielle de {len(missing)} tâche(s)\n")
+            gui_log.see(tk.END)
+        results = [result if result else _run_transcription_task(model, task) + (None,) for task, result in zip(tasks, results)]
+    else:
+        report_pool_memory(main_usage, [usage for *_, usage in results], model)
+    segments = {lang: [] for lang in languages}
+    for lang, temp_wav, transcription, error, _ in results:
+        if error:
+            with print_lock:
+                print(f"Erreur transcription {temp_wav} : {error}")
+            if gui_log:
+                gui_log.insert(tk.END, f"Erreur transcription {temp_wav} : {error}\n")
+                gui_log.see(tk.END)
+        segments[lang].extend(transcription)
+    for lang in languages:
+        write_transcription_files(lang, video_id, video_title, segments[lang])
+
 def embed_multiple_subtitles(video_file, srt_files, title, burn_subtitles):
     """Intègre les sous-titres dans une vidéo MKV, soit incrustés (burned-in), soit comme pistes séparées."""
     video_file = os.path.normpath(video_file)
@@ -306,13 +702,22 @@ def process_local_video(video_file, languages, quality, cleanup_files, burn_subt
             gui_log.insert(tk.END, f"Appel record_audio avec audio_file={audio_file}\n")
             gui_log.see(tk.END)
         temp_wav_files = record_audio(audio_file=audio_file)
-        for lang in languages:
+        num_workers = min(len(languages), os.cpu_count() or 1)
+        if num_workers > 1 and can_share_model(model):
             with print_lock:
-                print(f"Transcription pour la langue : {lang}, video_file={video_file}, video_title={video_title}")
+                print(f"Transcription parallèle pour les langues : {languages}, video_file={video_file}, video_title={video_title}")
             if gui_log:
-                gui_log.insert(tk.END, f"Transcription pour la langue : {lang}, video_file={video_file}, video_title={video_title}\n")
+                gui_log.insert(tk.END, f"Transcription parallèle pour les langues : {languages}, video_file={video_file}, video_title={video_title}\n")
                 gui_log.see(tk.END)
-            transcribe_audio(lang, video_file, video_title, temp_wav_files=temp_wav_files)
+            transcribe_languages_parallel(languages, video_file, video_title, model, num_workers, temp_wav_files=temp_wav_files)
+        else:
+            for lang in languages:
+                with print_lock:
+                    print(f"Transcription pour la langue : {lang}, video_file={video_file}, video_title={video_title}")
+                if gui_log:
+                    gui_log.insert(tk.END, f"Transcription pour la langue : {lang}, video_file={video_file}, video_title={video_title}\n")
+                    gui_log.see(tk.END)
+                transcribe_audio(lang, video_file, video_title, temp_wav_files=temp_wav_files)
         
         srt_files = [os.path.normpath(f"{SRT_OUTPUT_BASE}_{lang}.srt") for lang in languages]
         with print_lock:
@@ -643,7 +1048,7 @@ def gui_main():
             if model_name in ["tiny", "base"]:
                 log_text.insert(tk.END, "Avertissement : Modèle tiny/base peut avoir une précision limitée. Envisagez 'medium'.\n")
                 log_text.see(tk.END)
-            model = whisper.load_model(model_name)
+            model = load_model_cached(model_name)
             log_text.insert(tk.END, f"Modèle Whisper chargé : {model_name}\n")
             log_text.see(tk.END)
 
@@ -689,4 +1094,7 @@ def gui_main():
 
 if __name__ == "__main__":
     print(f"Constantes globales : RATE={RATE}, type={type(RATE)}, CHANNELS={CHANNELS}, type={type(CHANNELS)}")
-    gui_main()
\ No newline at end of file
+    if "--convert-models" in sys.argv:
+        convert_all_models()
+    else:
+        gui_main()
\ No newline at end of file